@@ -5,16 +5,19 @@ Minimal example of using theano and neural network and gradient decent
 import theano
 import theano.tensor as T
 import numpy as np
+from collections import OrderedDict
 # import theano.printing as tprint
 
 
 def shared_dataset(data_xy):
     """
     Transform data into theano.shared. This is important for parallelising computations later
+
+    The shared variables may alias the given arrays (borrow=True), so they must not be modified afterwards
     """
     data_x, data_y = data_xy
-    shared_x = theano.shared(np.asarray(data_x, dtype=theano.config.floatX))
-    shared_y = theano.shared(np.asarray(data_y, dtype=theano.config.floatX))
+    shared_x = theano.shared(np.ascontiguousarray(data_x, dtype=theano.config.floatX), borrow=True)
+    shared_y = theano.shared(np.ascontiguousarray(data_y, dtype=theano.config.floatX), borrow=True)
     return shared_x, shared_y
 
 
@@ -27,7 +30,7 @@ class HiddenLayer:
         self.input = input
 
         #: Weight matrix (n_in x n_nodes)
-        W_values = np.asarray(np.ones((n_in, n_nodes)) * 2, dtype=theano.config.floatX)
+        W_values = np.full((n_in, n_nodes), 2.0, dtype=theano.config.floatX)
         self.W = theano.shared(value=W_values, name='W', borrow=True)
 
         #: Bias term
@@ -48,7 +51,7 @@ class OutputLayer:
 
     def __init__(self, input_from_previous_layer, n_in, n_nodes):
         #: Weight matrix (n_in x n_nodes)
-        W_values = np.asarray(np.ones((n_in, n_nodes)) * 2, dtype=theano.config.floatX)
+        W_values = np.full((n_in, n_nodes), 2.0, dtype=theano.config.floatX)
         self.W = theano.shared(value=W_values, name='W', borrow=True)
 
         #: Bias term
@@ -58,8 +61,7 @@ class OutputLayer:
         #output using linear rectifier
         self.threshold = 1
         lin_output = T.dot(input_from_previous_layer, self.W) + self.b
-        above_threshold = lin_output > self.threshold
-        self.output = above_threshold * (lin_output - self.threshold)
+        self.output = T.nnet.relu(lin_output - self.threshold)
 
         #all the variables that can change during learning
         self.params = [self.W, self.b]
@@ -75,14 +77,14 @@ class OutputLayer:
         if y.ndim != self.output.ndim:
             raise TypeError('y should have the same shape as self.output', ('y', y.type, 'output', self.output.type))
 
-        return np.abs(T.mean(self.output-y))
+        return T.abs_(T.mean(self.output - y))
 
 
 class MLP:
     """
     Class which implements the classification algorithm (neural network in our case)
     """
-    def __init__(self, input, n_in, n_hidden, n_out):
+    def __init__(self, input, n_in, n_hidden, n_out, l1_coeff=0.0, l2_coeff=0.0):
 
         #: Hidden layer implements summation
         self.hidden_layer = HiddenLayer(input, n_in, n_hidden)
@@ -93,15 +95,24 @@ class MLP:
 
 
 
+        # Regularization terms are only built when their coefficient is nonzero, so that
+        # unused subgraphs are never handed to the optimizer
+        self.l1_coeff = l1_coeff
+        self.l2_coeff = l2_coeff
+
         # L1 norm ; one regularization option is to enforce L1 norm to
         # be small
-        self.L1 = abs(self.hidden_layer.W).sum() \
-                + abs(self.output_layer.W).sum()
+        self.L1 = None
+        if l1_coeff != 0.0:
+            self.L1 = abs(self.hidden_layer.W).sum() \
+                    + abs(self.output_layer.W).sum()
 
         # square of L2 norm ; one regularization option is to enforce
         # square of L2 norm to be small
-        self.L2_sqr = (self.hidden_layer.W ** 2).sum() \
-                    + (self.output_layer.W ** 2).sum()
+        self.L2_sqr = None
+        if l2_coeff != 0.0:
+            self.L2_sqr = (self.hidden_layer.W ** 2).sum() \
+                        + (self.output_layer.W ** 2).sum()
 
         self.params = self.hidden_layer.params + self.output_layer.params
 
@@ -110,8 +121,11 @@ def main():
 
     #: Define data sets
     #train_set = (np.array([[1, 1], [1, 0], [0, 1], [0, 0]]), np.array([1, 0, 0, 0]))
-    train_set = (np.array([[[0, 0], [0, 1], [1, 1], [1, 0]], [[0, 0], [0, 1], [1, 1], [1, 0]]]), np.array([[[0],[0], [1], [0]], [[0],[0], [1], [0]]]))
-    test_set = (np.array([[0, 0], [1, 0]]), np.array([0, 0]))
+    # Examples are stored as rows of a matrix and handed to the network batch_size rows at a time
+    train_set = (np.array([[0, 0], [0, 1], [1, 1], [1, 0], [0, 0], [0, 1], [1, 1], [1, 0]], dtype=theano.config.floatX),
+                 np.array([[0], [0], [1], [0], [0], [0], [1], [0]], dtype=theano.config.floatX))
+    batch_size = 4
+    test_set = (np.array([[0, 0], [1, 0]], dtype=theano.config.floatX), np.array([0, 0], dtype=theano.config.floatX))
 
     # Transform them to theano.shared
     train_set_x, train_set_y = shared_dataset(train_set)
@@ -125,16 +139,18 @@ def main():
     # Define some structures to store training data and labels
     x = T.matrix('x')
     y = T.matrix('y')
-    index = T.lscalar()
+    batch_index = T.lscalar()
 
 
     # Define the classification algorithm
     classifier = MLP(input=x, n_in=2, n_hidden=1, n_out=1)
 
-    #define the cost function using l1 and l2 regularization terms:
-    cost = classifier.output_layer.errors(y) \
-        + 0.0 * classifier.L1 \
-        + 0.0 * classifier.L2_sqr
+    #define the cost function using l1 and l2 regularization terms (if enabled):
+    cost = classifier.output_layer.errors(y)
+    if classifier.L1 is not None:
+        cost = cost + classifier.l1_coeff * classifier.L1
+    if classifier.L2_sqr is not None:
+        cost = cost + classifier.l2_coeff * classifier.L2_sqr
 
     # print type(cost)
 
@@ -146,32 +162,31 @@ def main():
 
     # Define how much we need to change the parameter values
     learning_rate = 0.02
-    updates = []
-    for param, gparam in zip(classifier.params, gparams):
-        updates.append((param, param - learning_rate * gparam))
+    updates = OrderedDict((param, param - learning_rate * gparam) for param, gparam in zip(classifier.params, gparams))
 
     print updates
 
     # Train model is a theano.function type object that performs updates on parameter values
-    train_model = theano.function(inputs=[index], outputs=cost,
+    train_model = theano.function(inputs=[batch_index], outputs=cost,
             updates=updates,
             givens={
-                x: train_set_x[index],
-                y: train_set_y[index]})
+                x: train_set_x[batch_index * batch_size:(batch_index + 1) * batch_size],
+                y: train_set_y[batch_index * batch_size:(batch_index + 1) * batch_size]})
 
     # We construct an object of type theano.function, which we call test_model
     test_model = theano.function(
-        inputs=[index],
+        inputs=[batch_index],
         outputs=[classifier.hidden_layer.input, classifier.output_layer.output, cost, classifier.hidden_layer.W,
                  classifier.hidden_layer.b, classifier.output_layer.W, classifier.output_layer.b],
         givens={
-            x: train_set_x[index],
-            y: train_set_y[index]})
+            x: train_set_x[batch_index * batch_size:(batch_index + 1) * batch_size],
+            y: train_set_y[batch_index * batch_size:(batch_index + 1) * batch_size]})
 
     n_train_points = train_set_x.get_value(borrow=True).shape[0]
     print "nr of training points is ", n_train_points
+    n_batches = n_train_points / batch_size
 
-    for i in range(n_train_points):
+    for i in range(n_batches):
         result = test_model(i)
         print "we calculated something: ", result
 
@@ -179,7 +194,7 @@ def main():
     for iteration in range(1000):
         cost = train_model(0)
 
-    for i in range(n_train_points):
+    for i in range(n_batches):
         result = test_model(i)
         print "we calculated something: ", result
 
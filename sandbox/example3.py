@@ -8,17 +8,20 @@ First test using convolution
 import theano
 import theano.tensor as T
 import numpy as np
-from theano.tensor.nnet import conv
+from collections import OrderedDict
+from theano.tensor.nnet import conv2d
 # import theano.printing as tprint
 import chessboard
 
 def shared_dataset(data_xy):
     """
     Transform data into theano.shared. This is important for parallelising computations later
+
+    The shared variables may alias the given arrays (borrow=True), so they must not be modified afterwards
     """
     data_x, data_y = data_xy
-    shared_x = theano.shared(np.asarray(data_x, dtype=theano.config.floatX))
-    shared_y = theano.shared(np.asarray(data_y, dtype=theano.config.floatX))
+    shared_x = theano.shared(np.ascontiguousarray(data_x, dtype=theano.config.floatX), borrow=True)
+    shared_y = theano.shared(np.ascontiguousarray(data_y, dtype=theano.config.floatX), borrow=True)
     return shared_x, shared_y
 
 
@@ -66,8 +69,7 @@ class OutputLayer:
         #output using linear rectifier
         self.threshold = 0
         lin_output = T.dot(input_from_previous_layer, self.W) + self.b
-        above_threshold = lin_output > self.threshold
-        self.output = above_threshold * (lin_output - self.threshold)
+        self.output = T.nnet.relu(lin_output - self.threshold)
 
         #all the variables that can change during learning
         self.params = [self.W, self.b]
@@ -83,7 +85,9 @@ class OutputLayer:
         if y.ndim != self.output.ndim:
             raise TypeError('y should have the same shape as self.output', ('y', y.type, 'output', self.output.type))
 
-        return np.abs(T.mean(self.output-y))
+        # mean of the per-example absolute errors, so that errors of opposite sign within a
+        # minibatch do not cancel out
+        return T.mean(T.abs_(self.output - y))
 
 
 class ConvolutionalLayer(object):
@@ -109,7 +113,7 @@ class ConvolutionalLayer(object):
         """
 
         assert image_shape[1] == filter_shape[1]
-        self.input = input
+        self.input = input_images
 
         # there are "num input feature maps * filter height * filter width"
         # inputs to each hidden unit
@@ -124,16 +128,18 @@ class ConvolutionalLayer(object):
         W_bound = np.sqrt(6. / (self.fan_in + self.fan_out))
 
         # initialize weights with random weights
-        self.W = theano.shared(np.asarray(np.random.uniform(high=W_bound, low=-W_bound, size=filter_shape), dtype=theano.config.floatX),
-                               borrow=True)
+        W_values = np.random.uniform(high=W_bound, low=-W_bound, size=filter_shape).astype(theano.config.floatX, copy=False)
+        self.W = theano.shared(W_values, borrow=True)
 
         # the bias is a 1D tensor -- one bias per output feature map
         b_values = np.zeros((filter_shape[0],), dtype=theano.config.floatX)
         self.b = theano.shared(value=b_values, borrow=True)
 
-        # convolve input feature maps with filters
-        convolution_output = conv.conv2d(input=input_images, filters=self.W,
-                filter_shape=filter_shape, image_shape=image_shape, subsample=(stride , stride))
+        # convolve input feature maps with filters. The abstract conv2d is lowered by Theano's
+        # optimizer to cuDNN on a GPU and to a CPU implementation otherwise; cuDNN's algorithm
+        # choice is set with e.g. THEANO_FLAGS=dnn.conv.algo_fwd=guess_once
+        convolution_output = conv2d(input=input_images, filters=self.W, input_shape=image_shape,
+                                    filter_shape=filter_shape, subsample=(stride, stride))
 
         # add the bias term. Since the bias is a vector (1D array), we first
         # reshape it to a tensor of shape (1,n_filters,1,1). Each bias will
@@ -141,8 +147,7 @@ class ConvolutionalLayer(object):
         # width & height
         self.threshold = 0
         activation = convolution_output + self.b.dimshuffle('x', 0, 'x', 'x')
-        #above_threshold = activation > self.threshold
-        #self.output = above_threshold * (activation - self.threshold)
+        #self.output = T.nnet.relu(activation - self.threshold)
         self.output=activation
         # store parameters of this layer
         self.params = [self.W, self.b]
@@ -152,7 +157,7 @@ class MLP:
     """
     Class which implements the classification algorithm (neural network in our case)
     """
-    def __init__(self, input, input_shape, filter_shapes, strides, n_hidden, n_out):
+    def __init__(self, input, input_shape, filter_shapes, strides, n_hidden, n_out, l1_coeff=0.0, l2_coeff=0.0):
 
 
         #: Convolutional layer
@@ -169,17 +174,26 @@ class MLP:
 
 
 
+        # Regularization terms are only built when their coefficient is nonzero, so that
+        # unused subgraphs are never handed to the optimizer
+        self.l1_coeff = l1_coeff
+        self.l2_coeff = l2_coeff
+
         # L1 norm ; one regularization option is to enforce L1 norm to
         # be small
-        self.L1 = abs(self.hidden_layer.W).sum() \
-                + abs(self.output_layer.W).sum() \
-                + abs(self.conv_layer.W).sum()
+        self.L1 = None
+        if l1_coeff != 0.0:
+            self.L1 = abs(self.hidden_layer.W).sum() \
+                    + abs(self.output_layer.W).sum() \
+                    + abs(self.conv_layer.W).sum()
 
         # square of L2 norm ; one regularization option is to enforce
         # square of L2 norm to be small
-        self.L2_sqr = (self.hidden_layer.W ** 2).sum() \
-                    + (self.output_layer.W ** 2).sum() \
-                    + (self.conv_layer.W ** 2).sum()
+        self.L2_sqr = None
+        if l2_coeff != 0.0:
+            self.L2_sqr = (self.hidden_layer.W ** 2).sum() \
+                        + (self.output_layer.W ** 2).sum() \
+                        + (self.conv_layer.W ** 2).sum()
 
         self.params = self.hidden_layer.params + self.output_layer.params + self.conv_layer.params
 
@@ -187,8 +201,8 @@ class MLP:
 def main():
 
     #: Define data sets
-    train_set = (np.array([chessboard.make_chessboard(8), chessboard.make_chessboard(2)]),
-                 np.array([[[10.0]], [[20.0]]]))
+    train_set = (np.array([chessboard.make_chessboard(8), chessboard.make_chessboard(2)], dtype=theano.config.floatX),
+                 np.array([[10.0], [20.0]], dtype=theano.config.floatX))
 
 
     # Transform them to theano.shared
@@ -200,71 +214,94 @@ def main():
     print train_set_x.eval()
     print train_set_y.eval()
 
+    n_train_points = train_set_x.get_value(borrow=True).shape[0]
+    print "nr of training points is ", n_train_points
+
     # Define some structures to store training data and labels
-    x = T.matrix('x')
+    x = T.tensor3('x')
     y = T.matrix('y')
-    index = T.lscalar()
+    batch_index = T.lscalar()
 
-    input_tensor=x.reshape((1,1,84,84))
+    # Feed the network whole minibatches so the dot products run as GEMM instead of GEMV.
+    # The same size is used as the static batch dimension of the convolution, so all images
+    # of a minibatch go through a single conv call (up to the DeepMind minibatch of 32)
+    batch_size = min(32, n_train_points)
+
+    input_tensor = x.reshape((batch_size, 1, 84, 84))
 
     # Define the classification algorithm
-    classifier = MLP(input=input_tensor, input_shape=[1, 1, 84, 84], filter_shapes=[[16, 1, 8, 8]], strides=[4], n_hidden=40, n_out=1)
+    classifier = MLP(input=input_tensor, input_shape=[batch_size, 1, 84, 84], filter_shapes=[[16, 1, 8, 8]], strides=[4], n_hidden=40, n_out=1)
 
-    #define the cost function using l1 and l2 regularization terms:
-    cost = classifier.output_layer.errors(y) \
-        + 0.0 * classifier.L1 \
-        + 0.0 * classifier.L2_sqr
+    #define the cost function using l1 and l2 regularization terms (if enabled):
+    cost = classifier.output_layer.errors(y)
+    if classifier.L1 is not None:
+        cost = cost + classifier.l1_coeff * classifier.L1
+    if classifier.L2_sqr is not None:
+        cost = cost + classifier.l2_coeff * classifier.L2_sqr
 
     print type(cost)
 
-    # Calculate the derivatives by each existing parameter
-    grads = T.grad(cost, classifier.params)
+    n_batches = n_train_points / batch_size
 
     # Define how much we need to change the parameter values
     learning_rate = 0.0001
-    updates = []
-    for param_i, gparam_i in zip(classifier.params, grads):
-        updates.append((param_i, param_i - learning_rate * gparam_i))
+
+    # Number of passes over the training set done by a single train_model call
+    n_epochs_per_call = 100
+
+    def sgd_step(step_batch_index, *params):
+        """
+        One gradient descent step on a single minibatch. The parameters are passed in by scan,
+        so the cost graph is cloned with them (and the minibatch) substituted in.
+        """
+        replace = dict(zip(classifier.params, params))
+        replace[x] = train_set_x[step_batch_index * batch_size:(step_batch_index + 1) * batch_size]
+        replace[y] = train_set_y[step_batch_index * batch_size:(step_batch_index + 1) * batch_size]
+        step_cost = theano.clone(cost, replace=replace)
+
+        # Calculate the derivatives by each existing parameter
+        step_grads = T.grad(step_cost, params)
+        return [step_cost] + [param_i - learning_rate * gparam_i for param_i, gparam_i in zip(params, step_grads)]
+
+    # Run all the SGD steps of n_epochs_per_call epochs inside scan, so the Python loop below
+    # only calls into Theano once per n_epochs_per_call epochs
+    step_batches = T.arange(n_epochs_per_call * n_batches) % n_batches
+    scan_outputs, _ = theano.scan(sgd_step, sequences=step_batches,
+                                  outputs_info=[None] + classifier.params)
+    step_costs = scan_outputs[0]
+    updates = OrderedDict((param_i, param_steps[-1]) for param_i, param_steps in zip(classifier.params, scan_outputs[1:]))
 
     #print updates
 
-    # Train model is a theano.function type object that performs updates on parameter values
-    train_model = theano.function(inputs=[index], outputs=cost,
-            updates=updates,
-            givens={
-                x: train_set_x[index],
-                y: train_set_y[index]})
+    # Train model is a theano.function type object that performs updates on parameter values.
+    # It returns the cost of every SGD step it did
+    train_model = theano.function(inputs=[], outputs=step_costs, updates=updates)
 
 
 
     # We construct an object of type theano.function, which we call test_model
     test_model = theano.function(
-        inputs=[index],
+        inputs=[batch_index],
         outputs=[classifier.conv_layer.W, classifier.hidden_layer.b, classifier.output_layer.W, classifier.output_layer.b, classifier.output_layer.output, cost],
         givens={
-            x: train_set_x[index],
-            y: train_set_y[index]
+            x: train_set_x[batch_index * batch_size:(batch_index + 1) * batch_size],
+            y: train_set_y[batch_index * batch_size:(batch_index + 1) * batch_size]
             })
 
-    n_train_points = train_set_x.get_value(borrow=True).shape[0]
-    print "nr of training points is ", n_train_points
-
-    for i in range(n_train_points):
+    for i in range(n_batches):
         result = test_model(i)
         print "we calculated something: ", result
 
 
     #lets train some iterations:
 
-    for i in range(10000):
-        cost = train_model(0)
-        cost = train_model(1)
-
-        result = test_model(0)
+    for i in range(10000 / n_epochs_per_call):
+        costs = train_model()
+        print "epoch %d: mean training cost %f, last %f" % ((i + 1) * n_epochs_per_call, costs.mean(), costs[-1])
 
-        print "test0: ", result[-3:]
-        result = test_model(1)
-        print "test1: ", result[-3:]
+        for batch in range(n_batches):
+            result = test_model(batch)
+            print "test%d: " % batch, result[-3:]
 
 
     #for i in range(n_train_points):
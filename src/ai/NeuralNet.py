@@ -8,6 +8,40 @@ from convnet import *
 import numpy as np
 import time
 from collections import OrderedDict
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+    @numba.njit(fastmath=True)
+    def _sum_abs(flat):
+        """
+        Sum the absolute values of a 1-D array without materialising abs(flat) as a temporary array.
+        """
+        acc = 0.0
+        for i in range(flat.size):
+            acc += abs(flat[i])
+        return acc
+else:
+    _sum_abs = None
+
+def _mean_abs_segments(arrays):
+    """
+    Compute the mean absolute value of each array. With numba each array is reduced in place by a
+    compiled loop; otherwise one vectorised numpy pass is done over their concatenation.
+
+    @param arrays: list of non-empty numpy.ndarrays
+    @return: 1-D numpy.ndarray with one mean per input array
+    """
+    sizes = np.array([a.size for a in arrays])
+    if _sum_abs is not None:
+        sums = np.array([_sum_abs(a.ravel(order='K')) for a in arrays])
+    else:
+        flat = np.concatenate([a.ravel() for a in arrays])
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        sums = np.add.reduceat(np.abs(flat), offsets, dtype=np.float64)
+    return sums / sizes
 
 class SimpleDataProvider:
     dims = None
@@ -45,18 +79,32 @@ class NeuralNet(ConvNet):
         self.layers_file = layers_file
         self.params_file = params_file
         self.output_layer_name = output_layer_name
+
+        # Dummy label buffers for predict(), one per batch size. Their values are never read,
+        # so they can be allocated once and reused on every call
+        self._pred_labels = {}
+
+        # Contiguous float32 target buffers for train(), one per batch size. Callers usually
+        # pass transposed views of their Q-values, which are copied into these instead of into
+        # a fresh array on every step
+        self._train_targets = {}
         
         # Initialise ConvNet, including self.libmodel
         op = NeuralNet.get_options_parser()
         op, load_dic = IGPUModel.parse_options(op)
         ConvNet.__init__(self, op, load_dic)
 
+        # Layers ordered by id, as reported by get_weight_stats()
+        self._sorted_layers = [l for name, l in sorted(self.layers.items(), key=lambda x: x[1]['id'])]
+
     def train(self, inputs, outputs):
         """
         Train neural net with inputs and outputs.
 
-        @param inputs: NxM numpy.ndarray, where N is number of inputs and M is batch size
-        @param outputs: KxM numpy.ndarray, where K is number of outputs and M is batch size
+        @param inputs: NxM numpy.ndarray, where N is number of inputs and M is batch size.
+                       Used as-is when already C-contiguous float32, copied otherwise
+        @param outputs: KxM numpy.ndarray, where K is number of outputs and M is batch size.
+                        It does not have to be contiguous, a transposed view is fine
         @return cost?
         """
 
@@ -64,8 +112,15 @@ class NeuralNet(ConvNet):
         assert outputs.shape[0] == self.nr_outputs
         assert inputs.shape[1] == outputs.shape[1]
 
+        batch_size = inputs.shape[1]
+        train_inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        if batch_size not in self._train_targets:
+            self._train_targets[batch_size] = np.empty((self.nr_outputs, batch_size), dtype=np.float32)
+        train_outputs = self._train_targets[batch_size]
+        np.copyto(train_outputs, outputs)
+
         # start training in GPU
-        self.libmodel.startBatch([inputs, outputs], 1, False) # second parameter is 'progress', third parameter means 'only test, don't train'
+        self.libmodel.startBatch([train_inputs, train_outputs], 1, False) # second parameter is 'progress', third parameter means 'only test, don't train'
         # wait until processing has finished
         cost = self.libmodel.finishBatch()
         # return cost (error)
@@ -81,9 +136,11 @@ class NeuralNet(ConvNet):
 
         batch_size = inputs.shape[1]
         outputs = np.zeros((batch_size, self.nr_outputs), dtype=np.float32)
+        if batch_size not in self._pred_labels:
+            self._pred_labels[batch_size] = np.zeros((self.nr_outputs, batch_size), dtype=np.float32)
 
         # start feed-forward pass in GPU
-        self.libmodel.startFeatureWriter([inputs, outputs.transpose().copy()], [outputs], [self.output_layer_name])
+        self.libmodel.startFeatureWriter([inputs, self._pred_labels[batch_size]], [outputs], [self.output_layer_name])
         # wait until processing has finished
         self.libmodel.finishBatch()
 
@@ -93,13 +150,22 @@ class NeuralNet(ConvNet):
     def get_weight_stats(self):
         # copy weights from GPU to CPU memory
         self.sync_with_host()
-        wscales = OrderedDict()
-        for name,val in sorted(self.layers.items(), key=lambda x: x[1]['id']): # This is kind of hacky but will do for now.
-            l = self.layers[name]
+        # gather all weight and increment arrays, so their statistics can be reduced in one go
+        keys, weights, increments = [], [], []
+        for l in self._sorted_layers:
             if 'weights' in l:
-                wscales[l['name'], 'biases'] = (n.mean(n.abs(l['biases'])), n.mean(n.abs(l['biasesInc'])))
+                keys.append((l['name'], 'biases'))
+                weights.append(l['biases'])
+                increments.append(l['biasesInc'])
                 for i,(w,wi) in enumerate(zip(l['weights'],l['weightsInc'])):
-                    wscales[l['name'], 'weights' + str(i)] = (n.mean(n.abs(w)), n.mean(n.abs(wi)))
+                    keys.append((l['name'], 'weights' + str(i)))
+                    weights.append(w)
+                    increments.append(wi)
+
+        wscales = OrderedDict()
+        if keys:
+            for key, w, wi in zip(keys, _mean_abs_segments(weights), _mean_abs_segments(increments)):
+                wscales[key] = (w, wi)
         return wscales
 
     def save_network(self, epoch):
@@ -110,7 +110,7 @@ class Main:
         #print "Corrected q-values: ", qvalues[0,:]
 
         # we have to transpose prediction result, as train expects input in opposite order
-        cost = self.nnet.train(prestates, qvalues.transpose().copy())
+        cost = self.nnet.train(prestates, qvalues.transpose())
 
         #qvalues = self.nnet.predict(prestates)
         #print "After training: ", qvalues[0,:]